@@ -2,7 +2,11 @@
 Utilities related to parsing files
 """
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+import codecs
+import mmap
+import os
+import re
 import sys
 
 PY3 = sys.version_info[0] == 3
@@ -12,15 +16,27 @@ __all__ = [
     'FixedLengthUnknownRecordTypeError',
     'FixedLengthSeparatorError',
     'FixedLengthJustificationError',
+    'FixedLengthFieldView',
     'FixedLengthFieldParser',
+    'materialize',
 ]
 
 if PY3:
-    def iteritems(d, **kw):
-        return iter(d.items(**kw))
+    text_type = str
 else:
-    def iteritems(d, **kw):
-        return d.iteritems(**kw)
+    text_type = unicode  # noqa: F821
+
+
+# Compiled parsers generated by FixedLengthFieldParser._generate_parser, keyed
+# by their source, so parsers for the same fields don't compile them again
+_code_cache = {}
+_MAX_CODE_CACHE = 100
+
+# How to parse one type of record; see FixedLengthFieldParser._compile_plan
+_RecordPlan = namedtuple(
+    '_RecordPlan',
+    ['size', 'parsers', 'separators', 'slices', 'make_record'],
+)
 
 
 class FixedLengthError(ValueError):
@@ -80,6 +96,117 @@ class FixedLengthJustificationError(FixedLengthError):
         )
 
 
+class FixedLengthFieldView(object):
+    """ A field value that is only decoded and stripped when first used
+
+    Views compare and hash like their value, which materialize() returns.
+
+    Arguments:
+        line (str):
+            The line (or value) the field is taken from.
+        start (int):
+            The offset of the field in the line.
+        end (int):
+            The offset of the end of the field in the line.
+        encoding (str):
+            The encoding to decode the field with, if any.
+        strip (bool):
+            Whether to strip whitespace from the field.
+    """
+    __slots__ = ('_line', '_start', '_end', '_encoding', '_strip', '_value')
+
+    def __init__(self, line, start, end, encoding=None, strip=True):
+        self._line = line
+        self._start = start
+        self._end = end
+        self._encoding = encoding
+        self._strip = strip
+
+    def materialize(self):
+        """ Returns the value of the field """
+        try:
+            return self._value
+        except AttributeError:
+            value = self._line[self._start:self._end]
+            if self._encoding is not None:
+                value = value.decode(self._encoding)
+            if self._strip:
+                value = value.strip()
+            self._value = value
+            # The line is no longer needed once the value is known
+            self._line = None
+            return value
+
+    def __eq__(self, other):
+        if isinstance(other, FixedLengthFieldView):
+            other = other.materialize()
+        return self.materialize() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        if isinstance(other, FixedLengthFieldView):
+            other = other.materialize()
+        return self.materialize() < other
+
+    def __le__(self, other):
+        if isinstance(other, FixedLengthFieldView):
+            other = other.materialize()
+        return self.materialize() <= other
+
+    def __gt__(self, other):
+        if isinstance(other, FixedLengthFieldView):
+            other = other.materialize()
+        return self.materialize() > other
+
+    def __ge__(self, other):
+        if isinstance(other, FixedLengthFieldView):
+            other = other.materialize()
+        return self.materialize() >= other
+
+    def __hash__(self):
+        return hash(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __bool__(self):
+        return bool(self.materialize())
+
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        """
+        Returns the value as text. Views are only bytes when the parser has no
+        encoding, so these are decoded as UTF-8, replacing any invalid bytes.
+        """
+        value = self.materialize()
+        if PY3 and isinstance(value, bytes):
+            return value.decode('utf-8', 'replace')
+        if not PY3 and isinstance(value, text_type):
+            return value.encode('utf-8')
+        return value
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.materialize())
+
+
+def materialize(record):
+    """
+    Returns a dictionary of a record's plain values, materializing any
+    FixedLengthFieldView values. The record may be a dictionary or a
+    namedtuple.
+    """
+    if not isinstance(record, dict):
+        record = record._asdict()
+    return dict(
+        (field, value.materialize()
+         if isinstance(value, FixedLengthFieldView) else value)
+        for field, value in record.items()
+    )
+
+
 class FixedLengthFieldParser(object):
     """
     Utility to parse and read from fixed-length field files.
@@ -97,7 +224,8 @@ class FixedLengthFieldParser(object):
         different types of records in the same file, a dictionary can be passed
         whose keys are record type indicators, and whose values are in the
         previously described format for fields. For these files, the
-        record_type_func parameter MUST be passed.
+        record_type_func parameter MUST be passed. The specification is read
+        once, when the parser is created.
     record_type_func
         For files with multiple record types, this must be a function that
         accepts a line from the file and returns a key into the fields dict.
@@ -121,12 +249,23 @@ class FixedLengthFieldParser(object):
     skip_unknown_types
         For files with multiple record types, indicate whether an unknown type
         should result in a ValueError or silently pass.
+    namedtuples
+        If True, records are returned as namedtuples (one class per record
+        type) instead of dictionaries, which are cheaper to build and store.
+        Field names must then be valid Python identifiers.
+    lazy
+        If True, values are FixedLengthFieldView objects that are only
+        decoded and stripped when first used, which saves the work for fields
+        that are never read. Call materialize() on a view to get its value,
+        or the module's materialize() function on a record to get a
+        dictionary of plain values.
     """
 
     def __init__(self, file_obj, fields, record_type_func=None,
                  override_justification_error_func=None, field_separator=None,
                  right_justified=(), skip_justified=(), encoding=None,
-                 skip_unknown_types=True, strip=True):
+                 skip_unknown_types=True, strip=True, namedtuples=False,
+                 lazy=False):
         self.file_obj = file_obj
         self.fields = fields
         self.record_type_func = record_type_func
@@ -134,75 +273,455 @@ class FixedLengthFieldParser(object):
             override_justification_error_func or (lambda f, v: None)
         )
         self.field_separator = field_separator
-        self.right_justified = right_justified
-        self.skip_justified = skip_justified
+        self.right_justified = frozenset(right_justified)
+        self.skip_justified = frozenset(skip_justified)
         self.encoding = encoding
         self.skip_unknown_types = skip_unknown_types
         self.strip = True
+        self.namedtuples = namedtuples
+        self.lazy = lazy
+
+        # Lines in these encodings can be decoded in one go. Latin-1 maps
+        # every byte to one character; the others only do so for ASCII lines,
+        # and other lines are decoded field by field.
+        self._line_encoding = None
+        if encoding is not None:
+            codec_name = codecs.lookup(encoding).name
+            if codec_name == 'iso8859-1':
+                self._line_encoding = 'latin-1'
+            elif codec_name in ('ascii', 'utf-8', 'cp1252'):
+                self._line_encoding = 'ascii'
+
+        # The field specification is static for the lifetime of the parser,
+        # so all offsets are worked out once up front rather than per record.
+        # This is the single dispatch table for records: one lookup by record
+        # type finds the plan, whose generated parsers are keyed by line
+        # type. Files with a single record type use a plan keyed by None.
+        if record_type_func:
+            self._plans = dict(
+                (record_type, self._compile_plan(field_length_sequence))
+                for record_type, field_length_sequence in fields.items()
+            )
+        else:
+            self._plans = {None: self._compile_plan(fields)}
 
     def __iter__(self):
+        # The same steps as process_fixed_length_record, inlined to save a
+        # method call per line
+        record_type_func = self.record_type_func
+        skip_unknown_types = self.skip_unknown_types
+        plans = self._plans
+        parse_fields = self._parse_fields
         for line in self.file_obj:
-            result = self.process_fixed_length_record(line)
-            if result is not None:
-                yield result
+            record_type = record_type_func(line) if record_type_func else None
+            plan = plans.get(record_type)
+            if plan is None:
+                if skip_unknown_types:
+                    continue
+                raise FixedLengthUnknownRecordTypeError(record_type)
+            parse = plan.parsers.get(type(line))
+            record = parse(line) if parse is not None else None
+            if record is None:
+                record = parse_fields(plan, line)
+            yield record
+
+    def _compile_plan(self, field_length_sequence):
+        """
+        Returns a _RecordPlan describing how to parse a record.
+
+        separators is a list of (field, start, end) tuples locating the
+        separator expected before each field, slices is a list of (field,
+        start, end, check_just, right_just) tuples, and size is the length of
+        a record. make_record builds a record from the list of its values.
+
+        parsers maps a line type to a function generated for this record
+        type, which parses well-formed lines and returns None otherwise.
+        Validation is done by a regular expression that only matches
+        well-formed records.
+        """
+        if isinstance(field_length_sequence, OrderedDict):
+            field_length_sequence = field_length_sequence.items()
+
+        separators = []
+        slices = []
+        pattern = []
+        pointer = 0
+        field_sep = self.field_separator
+        field_sep_len = len(field_sep or '')
+        if isinstance(field_sep, bytes):
+            sep_pattern = re.escape(field_sep.decode('latin-1'))
+        elif field_sep:
+            sep_pattern = re.escape(field_sep)
+
+        for field, field_length in field_length_sequence:
+            if pointer and field_sep_len:
+                separators.append((field, pointer, pointer + field_sep_len))
+                pattern.append(sep_pattern)
+                pointer += field_sep_len
+            # Justification is only checked for files without separators
+            check_just = (
+                not field_sep_len and field not in self.skip_justified
+            )
+            right_just = field in self.right_justified
+            slices.append((field, pointer, pointer + field_length,
+                           check_just, right_just))
+            if not check_just or not field_length:
+                pattern.append(u'(.{%d})' % field_length)
+            elif right_just:
+                pattern.append(u'(.{%d}\\S|\\s{%d})'
+                               % (field_length - 1, field_length))
+            else:
+                pattern.append(u'(\\S.{%d}|\\s{%d})'
+                               % (field_length - 1, field_length))
+            pointer += field_length
+
+        names = [field for field, _, _, _, _ in slices]
+        if self.namedtuples:
+            record_class = namedtuple('Record', names)
+            make_record = record_class._make
+        else:
+            record_class = None
+
+            def make_record(values):
+                return dict(zip(names, values))
+
+        # Separators only ever match lines of their own type
+        validate = separators or any(check for _, _, _, check, _ in slices)
+        validators = {}
+        if validate:
+            pattern = u''.join(pattern)
+            if not isinstance(field_sep, bytes):
+                validators[text_type] = re.compile(pattern, re.S | re.U)
+            if field_sep is None or isinstance(field_sep, bytes):
+                validators[bytes] = re.compile(pattern.encode('latin-1'),
+                                               re.S)
+
+        parsers = {}
+        for line_type in (text_type, bytes):
+            if validate and line_type not in validators:
+                continue
+            if line_type is text_type and self.encoding is not None:
+                continue
+            parsers[line_type] = self._generate_parser(
+                slices, validators.get(line_type), line_type, record_class)
+
+        return _RecordPlan(pointer, parsers, separators, slices, make_record)
+
+    def _generate_parser(self, slices, validator, line_type, record_class):
+        """
+        Generates the source of a function that parses lines of line_type
+        with the offsets written out as literals, and compiles it. The
+        function returns None for lines that the validator rejects.
+        """
+        def build_record(line, decode, indent):
+            """
+            Returns the statements that slice the values out of line,
+            decoding each of them if decode is set, and return the record
+            """
+            body = []
+            if self.lazy:
+                values = [
+                    'View(%s, %d, %d, %s, %r)' % (
+                        line, start, end, 'encoding' if decode else 'None',
+                        self.strip)
+                    for _, start, end, _, _ in slices
+                ]
+            else:
+                values = ['v%d' % index for index in range(len(slices))]
+                if validator is not None and line == 'record_line':
+                    body.append('%s, = match.groups()' % ', '.join(values))
+                else:
+                    for value, (_, start, end, _, _) in zip(values, slices):
+                        body.append('%s = %s[%d:%d]'
+                                    % (value, line, start, end))
+                if decode:
+                    for value in values:
+                        body.append('%s = %s.decode(encoding)'
+                                    % (value, value))
+                if self.strip:
+                    values = ['%s.strip()' % value for value in values]
+
+            if record_class is not None:
+                body.append('return Record(%s)' % ', '.join(values))
+            else:
+                # Field names can be any hashable, so they are bound as
+                # globals of the generated function rather than written into
+                # its source
+                body.append('return {%s}' % ', '.join(
+                    'k%d: %s' % (index, value)
+                    for index, value in enumerate(values)
+                ))
+            return [indent + statement for statement in body]
+
+        source = ['def parse(record_line):']
+        if validator is not None:
+            source += ['    match = validate(record_line)',
+                       '    if match is None:',
+                       '        return None']
+        if line_type is bytes and self._line_encoding:
+            # Lines that can't be decoded in one go (such as UTF-8 lines
+            # with non-ASCII characters) are decoded field by field instead
+            source += ['    try:',
+                       '        text = record_line.decode(line_encoding)',
+                       '    except UnicodeDecodeError:']
+            source += build_record('record_line', True, '        ')
+            source += build_record('text', False, '    ')
+        else:
+            source += build_record(
+                'record_line',
+                line_type is bytes and self.encoding is not None, '    ')
+
+        namespace = {
+            'validate': validator.match if validator else None,
+            'line_encoding': self._line_encoding,
+            'encoding': self.encoding,
+            'Record': record_class,
+            'View': FixedLengthFieldView,
+        }
+        for index, (field, _, _, _, _) in enumerate(slices):
+            namespace['k%d' % index] = field
+        source = '\n'.join(source) + '\n'
+        code = _code_cache.get(source)
+        if code is None:
+            if len(_code_cache) >= _MAX_CODE_CACHE:
+                _code_cache.clear()
+            code = _code_cache[source] = compile(source, '<fwffr-gen>',
+                                                 'exec')
+        exec(code, namespace)
+        return namespace['parse']
 
     def process_fixed_length_record(self, record_line):
         """
         Given the raw fixed-length record line, returns two dictionaries: the
         raw fields, and the processed and converted fields
         """
-        record = {}
-
-        pointer = 0
-        field_sep = self.field_separator or ''
-        field_sep_len = len(field_sep)
-
         if self.record_type_func:
             record_type = self.record_type_func(record_line)
-            if record_type not in self.fields:
+            plan = self._plans.get(record_type)
+            if plan is None:
                 if self.skip_unknown_types:
                     return None
                 else:
                     raise FixedLengthUnknownRecordTypeError(record_type)
-            field_length_sequence = self.fields[record_type]
         else:
-            field_length_sequence = self.fields
+            plan = self._plans[None]
 
-        if isinstance(field_length_sequence, OrderedDict):
-            field_length_sequence = iteritems(field_length_sequence)
+        parse = plan.parsers.get(type(record_line))
+        if parse is not None:
+            record = parse(record_line)
+            if record is not None:
+                return record
+        return self._parse_fields(plan, record_line)
 
-        for field, field_length in field_length_sequence:
-            # Check that fields are separated correctly
-            if pointer and field_sep_len:
-                if record_line[pointer:pointer + field_sep_len] != field_sep:
-                    raise FixedLengthSeparatorError(field, pointer)
-                pointer += field_sep_len
-
-            value = record_line[pointer:pointer + field_length]
-            # Check that the field is empty or doesn't start with a space
-            if not field_sep_len:
-                if self._invalid_just(field, value):
-                    override = self.override_justification_error_func(field, value)
+    def _parse_fields(self, plan, record_line):
+        """
+        Parses a record field by field with the given plan, so that errors
+        can be reported or overridden. This handles anything the generated
+        parser couldn't.
+        """
+        # Justification is never checked alongside separators, so checking
+        # them all up front reports the same error as checking them in turn.
+        field_sep = self.field_separator
+        for field, start, end in plan.separators:
+            if record_line[start:end] != field_sep:
+                raise FixedLengthSeparatorError(field, start)
+
+        record = []
+        override_func = self.override_justification_error_func
+        encoding = self.encoding
+        strip = self.strip
+        lazy = self.lazy
+
+        for field, start, end, check_just, right_just in plan.slices:
+            value = record_line[start:end]
+            # Kept when the check has stripped the value and it is returned
+            # as is, so it doesn't need stripping again
+            stripped = None
+            # Check that the field is empty or doesn't start with a space.
+            # A non-empty value has whitespace at an edge exactly when its
+            # edge character differs from its stripped form's, which indexes
+            # both rather than slicing out the edge (and works the same for
+            # str and bytes).
+            if check_just:
+                stripped = value.strip()
+                if stripped and (
+                        value[-1] != stripped[-1] if right_just
+                        else value[0] != stripped[0]):
+                    override = override_func(field, value)
                     if override is None:
                         raise FixedLengthJustificationError(field, value)
                     else:
                         value = override
-            if self.encoding is not None:
-                value = value.decode(self.encoding)
-            record[field] = value.strip() if self.strip else value
-            pointer += field_length
-
-        return record
+                        stripped = None
+            if lazy:
+                value = FixedLengthFieldView(value, 0, len(value),
+                                             encoding, strip)
+            elif encoding is not None:
+                value = value.decode(encoding)
+                if strip:
+                    value = value.strip()
+            elif strip:
+                value = value.strip() if stripped is None else stripped
+            record.append(value)
+
+        return plan.make_record(record)
+
+    def read_all_columns(self, n_workers=1, chunk_records=4096):
+        """
+        Parses the whole file in one pass, returning a NumPy structured array
+        with a fixed-width bytes column for each field.
+
+        This requires numpy and only supports files with a single record type,
+        opened in binary mode, where every record (including the last) is the
+        same length and terminated by a newline. Records are read from the
+        current position of the file to its end. The file is memory mapped
+        and the array is a view onto it, so values are neither stripped nor
+        decoded; use the numpy.char functions to do so on whole columns.
+        Values returned by override_justification_error_func are written
+        back into their column, truncated to the width of the field.
+        A text field_separator is encoded with the encoding, or as ASCII.
+
+        n_workers
+            The number of threads used to validate the records. Using more
+            than one requires concurrent.futures, which on Python 2 is
+            provided by the futures backport (installed by the numpy extra).
+        chunk_records
+            The number of records validated at a time.
+        """
+        import numpy as np
 
-    def _invalid_just(self, field, value):
-        """ Returns True if the value is not justified correctly """
-        if field in self.skip_justified:
-            return False
-        if field in self.right_justified:
-            value = value.lstrip()[-1:]
+        if self.record_type_func:
+            raise ValueError("Files with multiple record types are "
+                             "not supported")
+        if n_workers < 1:
+            raise ValueError("n_workers must be at least 1, not %r"
+                             % (n_workers,))
+        if chunk_records < 1:
+            raise ValueError("chunk_records must be at least 1, not %r"
+                             % (chunk_records,))
+        plan = self._plans[None]
+        slices = plan.slices
+
+        # Records are read from the current position of the file, so any
+        # header already read from it is skipped. Mappings have to start at a
+        # multiple of the allocation granularity, so the records start skip
+        # bytes into the mapping.
+        fileno = self.file_obj.fileno()
+        position = self.file_obj.tell()
+        skip = position % mmap.ALLOCATIONGRANULARITY
+        if os.fstat(fileno).st_size > position:
+            # A private mapping lets overrides be written into the array
+            # without touching the file
+            buf = mmap.mmap(fileno, 0, access=mmap.ACCESS_COPY,
+                            offset=position - skip)
+            size = len(buf) - skip
+            # The first record sets the length of them all. A file without
+            # any newline is a single unterminated record.
+            newline = buf.find(b'\n', skip)
+            terminated = newline >= 0
+            record_size = newline - skip + 1 if terminated else size
+        else:
+            buf = b''
+            skip = size = 0
+            record_size = plan.size + 1
+            terminated = True
+        if record_size - terminated < plan.size:
+            raise ValueError(
+                "Records are %d bytes long but the fields span %d bytes"
+                % (record_size - terminated, plan.size)
+            )
+        if size % record_size:
+            raise ValueError("Records are not all %d bytes long (including "
+                             "the newline)" % record_size)
+
+        records = np.frombuffer(buf, offset=skip, dtype=np.dtype({
+            'names': [field for field, _, _, _, _ in slices],
+            'formats': ['S%d' % (end - start)
+                        for _, start, end, _, _ in slices],
+            'offsets': [start for _, start, _, _, _ in slices],
+            'itemsize': record_size,
+        }))
+        raw = np.frombuffer(buf, dtype=np.uint8, offset=skip).reshape(
+            -1, record_size)
+        if terminated and not (raw[:, -1] == 0x0A).all():
+            raise ValueError("Records are not all %d bytes long (including "
+                             "the newline)" % record_size)
+
+        if plan.separators:
+            # Text separators are encoded to match the bytes of the file, and
+            # must keep their length, which the field offsets are based on
+            field_sep = self.field_separator
+            if not isinstance(field_sep, bytes):
+                field_sep = field_sep.encode(self.encoding or 'ascii')
+                if len(field_sep) != len(self.field_separator):
+                    raise ValueError(
+                        "Field separator %r is not one byte per character"
+                        % (self.field_separator,)
+                    )
+            field_sep = np.frombuffer(field_sep, dtype=np.uint8)
+        checked = [(order, field_slice)
+                   for order, field_slice in enumerate(slices)
+                   if field_slice[3] and field_slice[1] < field_slice[2]]
+        bounds = []
+        for _, (_, start, end, _, _) in checked:
+            bounds.extend((start, end))
+        if bounds and bounds[-1] == record_size:
+            bounds.pop()
+
+        def check_chunk(offset):
+            """
+            Returns the separator errors and misjustified fields found in the
+            chunk of records starting at offset, as (index, order, ...) tuples
+            """
+            chunk = raw[offset:offset + chunk_records]
+            errors = []
+            for order, (field, start, end) in enumerate(plan.separators):
+                bad = (chunk[:, start:end] != field_sep).any(axis=1)
+                if bad.any():
+                    errors.append((offset + bad.argmax(), order, field, start))
+
+            invalid = []
+            if checked:
+                # Classify every byte once, then reduce all of the checked
+                # field spans in a single call rather than one per field
+                is_space = (chunk == 0x20) | (chunk - 0x09 <= 0x04)
+                all_space = np.logical_and.reduceat(is_space, bounds, axis=1)
+                for column, (order, field_slice) in enumerate(checked):
+                    field, start, end, _, right_just = field_slice
+                    edge = end - 1 if right_just else start
+                    bad = is_space[:, edge] & ~all_space[:, column * 2]
+                    for index in np.flatnonzero(bad):
+                        invalid.append((offset + index, order, field,
+                                        start, end))
+            return errors, invalid
+
+        # Records are checked in cache-sized chunks. NumPy releases the GIL
+        # for the bulk of this work, so chunks can be spread over threads.
+        offsets = range(0, len(raw), chunk_records)
+        if n_workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(n_workers) as executor:
+                results = list(executor.map(check_chunk, offsets))
         else:
-            value = value.rstrip()[:1]
-        return value.isspace()
+            results = [check_chunk(offset) for offset in offsets]
+
+        # Report the same error the line-by-line parser would raise first:
+        # the earliest record, then the earliest field within that record
+        invalid = []
+        for errors, chunk_invalid in results:
+            if errors:
+                _, _, field, start = min(errors)
+                raise FixedLengthSeparatorError(field, start)
+            invalid.extend(chunk_invalid)
+
+        for index, _, field, start, end in sorted(invalid):
+            value = raw[index, start:end].tobytes()
+            override = self.override_justification_error_func(field, value)
+            if override is None:
+                raise FixedLengthJustificationError(field, value)
+            records[field][index] = override
+
+        return records
 
     @classmethod
     def generate_type_from_offset_func(cls, position, length):
@@ -34,6 +34,9 @@ setup(
     py_modules=['fwffr'],
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'numpy': ['numpy', 'futures; python_version < "3.2"'],
+    },
     license="MIT license",
     zip_safe=False,
     keywords='fwffr',
@@ -4,19 +4,316 @@
 """Tests for `fwffr` package."""
 
 
+from collections import OrderedDict
+import io
+import mmap
+import os
+import tempfile
 import unittest
 
 import fwffr
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+FIELDS = [('name', 5), ('amount', 4), ('code', 2)]
+
+
+def parse(lines, fields=FIELDS, **kwargs):
+    return list(fwffr.FixedLengthFieldParser(lines, fields, **kwargs))
+
 
 class TestFwffr(unittest.TestCase):
     """Tests for `fwffr` package."""
 
-    def setUp(self):
-        """Set up test fixtures, if any."""
+    def test_parse_text_lines(self):
+        """Fields are sliced out and stripped."""
+        records = parse(io.StringIO(u'ab     12x \ncd      3yy\n'),
+                        right_justified=('amount',))
+        self.assertEqual(records, [
+            {'name': u'ab', 'amount': u'12', 'code': u'x'},
+            {'name': u'cd', 'amount': u'3', 'code': u'yy'},
+        ])
+
+    def test_parse_bytes_lines(self):
+        """Bytes lines give bytes values when no encoding is set."""
+        records = parse(io.BytesIO(b'ab   12  x \n'))
+        self.assertEqual(records, [
+            {'name': b'ab', 'amount': b'12', 'code': b'x'},
+        ])
+
+    def test_ordered_dict_fields(self):
+        """An OrderedDict field specification is equivalent to a list."""
+        records = parse([u'ab   12  x '], OrderedDict(FIELDS))
+        self.assertEqual(records, [
+            {'name': u'ab', 'amount': u'12', 'code': u'x'},
+        ])
+
+    def test_short_line(self):
+        """Fields past the end of a short line are empty."""
+        self.assertEqual(parse([u'ab   1\n']), [
+            {'name': u'ab', 'amount': u'1', 'code': u''},
+        ])
+
+    def test_left_justification_error(self):
+        """A left-justified field may not start with whitespace."""
+        with self.assertRaises(fwffr.FixedLengthJustificationError) as ctx:
+            parse([u' ab  12  x '])
+        self.assertEqual(ctx.exception.field, 'name')
+        self.assertEqual(ctx.exception.value, u' ab  ')
+
+    def test_right_justification_error(self):
+        """A right-justified field may not end with whitespace."""
+        with self.assertRaises(fwffr.FixedLengthJustificationError) as ctx:
+            parse([u'ab   12  x '], right_justified=('amount',))
+        self.assertEqual(ctx.exception.field, 'amount')
+        self.assertEqual(ctx.exception.value, u'12  ')
+
+    def test_blank_fields_are_justified(self):
+        """Fields of only whitespace pass either justification check."""
+        self.assertEqual(parse([u'ab         '], right_justified=('code',)), [
+            {'name': u'ab', 'amount': u'', 'code': u''},
+        ])
+
+    def test_skip_justified(self):
+        """Skip-justified fields are not checked."""
+        self.assertEqual(parse([u' ab  12  x '], skip_justified=('name',)), [
+            {'name': u'ab', 'amount': u'12', 'code': u'x'},
+        ])
+
+    def test_override_justification_error(self):
+        """The override hook replaces misjustified values."""
+        seen = []
+
+        def override(field, value):
+            seen.append((field, value))
+            return u'fixed' if field == 'name' else None
+
+        records = parse([u' ab  12  x '],
+                        override_justification_error_func=override)
+        self.assertEqual(seen, [('name', u' ab  ')])
+        self.assertEqual(records[0]['name'], u'fixed')
+
+        with self.assertRaises(fwffr.FixedLengthJustificationError):
+            parse([u'ab    12 x '], override_justification_error_func=override)
+
+    def test_separator(self):
+        """Separators are skipped and disable justification checks."""
+        records = parse([u' ab  | 12 |x \n'], field_separator=u'|')
+        self.assertEqual(records, [
+            {'name': u'ab', 'amount': u'12', 'code': u'x'},
+        ])
+
+    def test_separator_error(self):
+        """A missing separator reports the field and offset."""
+        with self.assertRaises(fwffr.FixedLengthSeparatorError) as ctx:
+            parse([u'ab   | 12 #x \n'], field_separator=u'|')
+        self.assertEqual(ctx.exception.field, 'code')
+        self.assertEqual(ctx.exception.pointer, 10)
+
+    def test_bytes_separator(self):
+        """Bytes lines need a bytes separator."""
+        self.assertEqual(parse([b'ab   |12  |x \n'], field_separator=b'|'), [
+            {'name': b'ab', 'amount': b'12', 'code': b'x'},
+        ])
+        with self.assertRaises(fwffr.FixedLengthSeparatorError):
+            parse([b'ab   |12  |x \n'], field_separator=u'|')
+
+    def test_encodings(self):
+        """Values are decoded with the encoding, whatever their content."""
+        for encoding in ('latin-1', 'utf-8'):
+            text = u'é    12  x \n'
+            records = parse([text.encode(encoding)], encoding=encoding,
+                            fields=[('name', len(u'é'.encode(encoding)) + 4),
+                                    ('amount', 4), ('code', 2)])
+            self.assertEqual(records, [
+                {'name': u'é', 'amount': u'12', 'code': u'x'},
+            ])
+            self.assertEqual(parse([b'ab   12  x \n'], encoding=encoding), [
+                {'name': u'ab', 'amount': u'12', 'code': u'x'},
+            ])
+
+    def test_non_ascii_utf8_lines(self):
+        """Non-ASCII UTF-8 lines are parsed without falling back."""
+        line = u'caf\xe9 \xfc\xfc\xfc\xfc'.encode('utf-8') + b' \n'
+        fields = [('name', 6), ('amount', 8), ('code', 1)]
+        expected = {'name': u'caf\xe9', 'amount': u'\xfc\xfc\xfc\xfc',
+                    'code': u''}
+        for lazy in (False, True):
+            parser = fwffr.FixedLengthFieldParser(
+                [line], fields, encoding='utf-8', lazy=lazy,
+                right_justified=('amount',))
+            parse_line = parser._plans[None].parsers[bytes]
+            self.assertEqual(fwffr.materialize(parse_line(line)), expected)
+            self.assertEqual([fwffr.materialize(record)
+                              for record in parser], [expected])
+
+    def test_multiple_record_types(self):
+        """Records are parsed with the fields for their type."""
+        fields = {
+            u'H': [('type', 1), ('title', 5)],
+            u'D': [('type', 1), ('value', 3)],
+        }
+        record_type_func = (
+            fwffr.FixedLengthFieldParser.generate_type_from_offset_func(0, 1)
+        )
+        lines = [u'Htitle\n', u'D  7\n', u'Xjunk\n']
+        records = parse(lines, fields, record_type_func=record_type_func,
+                        right_justified=('value',))
+        self.assertEqual(records, [
+            {'type': u'H', 'title': u'title'},
+            {'type': u'D', 'value': u'7'},
+        ])
+
+        with self.assertRaises(fwffr.FixedLengthUnknownRecordTypeError) as ctx:
+            parse(lines, fields, record_type_func=record_type_func,
+                  right_justified=('value',), skip_unknown_types=False)
+        self.assertEqual(ctx.exception.record_type, u'X')
+
+    def test_process_fixed_length_record(self):
+        """Single records can be processed directly."""
+        parser = fwffr.FixedLengthFieldParser([], FIELDS)
+        self.assertEqual(parser.process_fixed_length_record(u'ab   12  x '),
+                         {'name': u'ab', 'amount': u'12', 'code': u'x'})
+
+    def test_hashable_field_names(self):
+        """Field names can be any hashable, not just strings."""
+        key = object()
+        self.assertEqual(parse([u'abcd'], [(key, 2), (3, 2)]),
+                         [{key: u'ab', 3: u'cd'}])
+
+    def test_namedtuples(self):
+        """Records can be returned as namedtuples."""
+        records = parse([u'ab   12  x ', u' ab  12  x '], namedtuples=True,
+                        override_justification_error_func=lambda f, v: u'z')
+        self.assertEqual([tuple(record) for record in records], [
+            (u'ab', u'12', u'x'),
+            (u'z', u'12', u'x'),
+        ])
+        self.assertEqual(records[0].amount, u'12')
+
+    def test_lazy(self):
+        """Lazy records hold views that behave like their values."""
+        records = parse([b'b    12    \n', b'a      3 x\n'], lazy=True,
+                        encoding='latin-1', skip_justified=('amount',))
+        first, second = records
+        self.assertIsInstance(first['name'], fwffr.FixedLengthFieldView)
+        self.assertEqual(first['name'], u'b')
+        self.assertEqual(first['name'].materialize(), u'b')
+        self.assertEqual(str(second['code']), 'x')
+        self.assertFalse(first['code'])
+        self.assertEqual(len(first['amount']), 2)
+        self.assertEqual(sorted([first['name'], second['name']]),
+                         [u'a', u'b'])
+        self.assertEqual(fwffr.materialize(second),
+                         {'name': u'a', 'amount': u'3', 'code': u'x'})
+
+    def test_lazy_bytes_str(self):
+        """str() of a bytes view is its text."""
+        record, = parse([b'ab   12  x \n'], lazy=True, namedtuples=True)
+        self.assertEqual(str(record.name), 'ab')
+        self.assertEqual(fwffr.materialize(record),
+                         {'name': b'ab', 'amount': b'12', 'code': b'x'})
+
+    def test_lazy_str_not_utf8(self):
+        """str() of a view doesn't fail on bytes that aren't UTF-8."""
+        record, = parse([b'\xe9b c 12  x \n'], lazy=True)
+        expected = u'\ufffdb c' if fwffr.PY3 else b'\xe9b c'
+        self.assertEqual(str(record['name']), expected)
+        self.assertEqual('%s' % record['name'], expected)
+        record, = parse([b'\xe9b c 12  x \n'], lazy=True,
+                        encoding='cp1252')
+        self.assertEqual(u'%s' % record['name'], u'\xe9b c')
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestReadAllColumns(unittest.TestCase):
+    """Tests for `FixedLengthFieldParser.read_all_columns`."""
+
+    def read(self, data, fields=FIELDS, header=None, **kwargs):
+        handle, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, 'wb') as file_obj:
+            if header is not None:
+                file_obj.write(header)
+            file_obj.write(data)
+        options = dict((key, kwargs.pop(key))
+                       for key in ('n_workers', 'chunk_records')
+                       if key in kwargs)
+        with open(path, 'rb') as file_obj:
+            if header is not None:
+                file_obj.readline()
+            parser = fwffr.FixedLengthFieldParser(file_obj, fields, **kwargs)
+            return parser.read_all_columns(**options)
+
+    def test_columns(self):
+        """Each field is a column, single-threaded or not."""
+        data = b'ab   12  x \n' * 10
+        for options in ({}, {'n_workers': 3, 'chunk_records': 4}):
+            records = self.read(data, **options)
+            self.assertEqual(len(records), 10)
+            self.assertEqual(list(records['name']), [b'ab   '] * 10)
+            self.assertEqual(list(records['code']), [b'x '] * 10)
+
+    def test_empty_file(self):
+        """An empty file has no records."""
+        self.assertEqual(len(self.read(b'')), 0)
+
+    def test_file_position(self):
+        """Records are read from the current position of the file."""
+        data = b'ab   12  x \n' * 3
+        for size in (0, 1, mmap.ALLOCATIONGRANULARITY + 1):
+            header = b'h' * size + b'\n'
+            records = self.read(data, header=header)
+            self.assertEqual(list(records['amount']), [b'12  '] * 3)
+            self.assertEqual(len(self.read(b'', header=header)), 0)
+
+    def test_justification_error(self):
+        """The first misjustified field in file order is reported."""
+        data = b'ab   12  x \n' * 5 + b'ab    12 x \n' + b' ab  12  x \n'
+        for options in ({}, {'n_workers': 2, 'chunk_records': 2}):
+            with self.assertRaises(
+                    fwffr.FixedLengthJustificationError) as ctx:
+                self.read(data, **options)
+            self.assertEqual(ctx.exception.field, 'amount')
+
+    def test_override(self):
+        """Overrides are written back into their column."""
+        records = self.read(
+            b' ab  12  x \n',
+            override_justification_error_func=lambda f, v: v.strip(),
+        )
+        self.assertEqual(records['name'][0], b'ab')
+
+    def test_separator_error(self):
+        """A missing separator is reported."""
+        with self.assertRaises(fwffr.FixedLengthSeparatorError) as ctx:
+            self.read(b'ab   |12  |x \nab   #12  |x \n',
+                      field_separator=b'|')
+        self.assertEqual(ctx.exception.field, 'amount')
+
+    def test_text_separator(self):
+        """Text separators are encoded to match the file."""
+        records = self.read(b'ab   |12  |x \n', field_separator=u'|')
+        self.assertEqual(list(records['amount']), [b'12  '])
+        with self.assertRaises(fwffr.FixedLengthSeparatorError):
+            self.read(b'ab   #12  |x \n', field_separator=u'|')
+        with self.assertRaises(ValueError) as ctx:
+            self.read(b'ab   \xc2\xa712  \xc2\xa7x \n',
+                      field_separator=u'\xa7', encoding='utf-8')
+        self.assertNotIsInstance(ctx.exception, fwffr.FixedLengthError)
 
-    def tearDown(self):
-        """Tear down test fixtures, if any."""
+    def test_bad_record_lengths(self):
+        """Short or ragged records are rejected."""
+        for data in (b'abcd\nfghi\n', b'abcde\nfghi\nxklmno\n'):
+            with self.assertRaises(ValueError):
+                self.read(data, [('a', 2), ('b', 3)])
 
-    def test_000_something(self):
-        """Test something."""
+    def test_bad_arguments(self):
+        """Worker and chunk counts must be positive."""
+        for options in ({'n_workers': 0}, {'chunk_records': 0}):
+            with self.assertRaises(ValueError):
+                self.read(b'ab   12  x \n', **options)